@@ -1,7 +1,11 @@
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from model_utils.models import TimeStampedModel
 
+from student.models import CourseEnrollment
+
 
 class ExperimentData(TimeStampedModel):
     """
@@ -41,3 +45,18 @@ class ExperimentKeyValue(TimeStampedModel):
         unique_together = (
             ('experiment_id', 'key'),
         )
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=CourseEnrollment,
+    dispatch_uid='clear_experiment_user_metadata_on_enrollment_change',
+)
+def clear_experiment_user_metadata_on_enrollment_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Clear the cached experiment user metadata of the enrollment's user in every course when the enrollment changes,
+    since the program information of each course depends on all of the user's enrollments.
+    """
+    # Import is placed here to avoid importing the experiment utils' dependencies at model load time.
+    from .utils import clear_experiment_user_metadata_cache
+    clear_experiment_user_metadata_cache(instance.user_id)
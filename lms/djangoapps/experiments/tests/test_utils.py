@@ -3,9 +3,22 @@ Tests of experiment functionality
 """
 from decimal import Decimal
 from unittest import TestCase
-from lms.djangoapps.experiments.utils import get_course_entitlement_price_and_sku, get_program_price_and_skus, \
-    get_unenrolled_courses, is_enrolled_in_course_run
+
+import crum
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import Mock, patch
+
+from lms.djangoapps.experiments.utils import get_course_entitlement_price_and_sku, \
+    get_experiment_user_metadata_context, get_program_price_and_skus, partition_courses_by_enrollment, \
+    stable_bucketing_hash_group, PROGRAM_INFO_FLAG, PROGRAM_PRICE_FLAG
 from opaque_keys.edx.keys import CourseKey
+from openedx.core.djangoapps.waffle_utils.testutils import override_waffle_flag
+from openedx.core.djangolib.testing.utils import CacheIsolationTestCase, get_mock_request
+from student.tests.factories import CourseEnrollmentFactory, UserFactory
+from xmodule.modulestore.tests.django_utils import SharedModuleStoreTestCase
+from xmodule.modulestore.tests.factories import CourseFactory
 
 
 class ExperimentUtilsTests(TestCase):
@@ -29,36 +42,63 @@ class ExperimentUtilsTests(TestCase):
         self.entitlement_a = {'mode': 'verified', 'price': self.entitlement_a_price, 'sku': self.entitlement_a_sku}
 
     def test_valid_course_run_key_enrollment(self):
-        course_run = {
-            'key': 'course-v1:DelftX+NGIx+RA0',
-        }
-        enrollment_ids = {CourseKey.from_string('course-v1:DelftX+NGIx+RA0')}
-        self.assertTrue(is_enrolled_in_course_run(course_run, enrollment_ids))
+        course = {'key': 'DelftX+NGIx', 'course_runs': [{'key': 'course-v1:DelftX+NGIx+RA0'}]}
+        enrollment_ids = frozenset([CourseKey.from_string('course-v1:DelftX+NGIx+RA0')])
+        enrolled_in_all, _ = partition_courses_by_enrollment([course], enrollment_ids, frozenset())
+        self.assertTrue(enrolled_in_all)
 
     def test_invalid_course_run_key_enrollment(self):
-        course_run = {
-            'key': 'cr_key',
-        }
-        enrollment_ids = {CourseKey.from_string('course-v1:DelftX+NGIx+RA0')}
-        self.assertFalse(is_enrolled_in_course_run(course_run, enrollment_ids))
+        course = {'key': 'DelftX+NGIx', 'course_runs': [{'key': 'cr_key'}]}
+        enrollment_ids = frozenset([CourseKey.from_string('course-v1:DelftX+NGIx+RA0')])
+        enrolled_in_all, _ = partition_courses_by_enrollment([course], enrollment_ids, frozenset())
+        self.assertFalse(enrolled_in_all)
 
     def test_program_price_and_skus_for_empty_courses(self):
         price, skus = get_program_price_and_skus([])
         self.assertEqual(None, price)
         self.assertEqual(None, skus)
 
-    def test_unenrolled_courses_for_empty_courses(self):
-        unenrolled_courses = get_unenrolled_courses([], [])
+    def test_partition_courses_by_enrollment_for_empty_courses(self):
+        enrolled_in_all, unenrolled_courses = partition_courses_by_enrollment([], frozenset(), frozenset())
+        self.assertTrue(enrolled_in_all)
         self.assertEqual([], unenrolled_courses)
 
-    def test_unenrolled_courses_for_single_course(self):
+    def test_partition_courses_by_enrollment_for_course_without_runs(self):
         course = {'key': 'UQx+ENGY1x'}
-        courses_in_program = [course]
-        user_enrollments = []
 
-        unenrolled_courses = get_unenrolled_courses(courses_in_program, user_enrollments)
-        expected_unenrolled_courses = [course]
-        self.assertEqual(expected_unenrolled_courses, unenrolled_courses)
+        enrolled_in_all, unenrolled_courses = partition_courses_by_enrollment([course], frozenset(), frozenset())
+        self.assertFalse(enrolled_in_all)
+        self.assertEqual([course], unenrolled_courses)
+
+    def test_partition_courses_by_enrollment_excludes_enrolled_course(self):
+        enrolled_course = {'key': 'DelftX+NGIx', 'course_runs': [{'key': 'course-v1:DelftX+NGIx+RA0'}]}
+        unenrolled_course = {'key': 'UQx+ENGY1x', 'course_runs': [{'key': 'course-v1:UQx+ENGY1x+3T2017'}]}
+        enrollment_course_ids = frozenset([CourseKey.from_string('course-v1:DelftX+NGIx+RA0')])
+
+        enrolled_in_all, unenrolled_courses = partition_courses_by_enrollment(
+            [enrolled_course, unenrolled_course], enrollment_course_ids, enrollment_course_ids
+        )
+        self.assertFalse(enrolled_in_all)
+        self.assertEqual([unenrolled_course], unenrolled_courses)
+
+    def test_partition_courses_by_enrollment(self):
+        verified_course = {'key': 'DelftX+NGIx', 'course_runs': [{'key': 'course-v1:DelftX+NGIx+RA0'}]}
+        audit_course = {'key': 'UQx+ENGY1x', 'course_runs': [{'key': 'course-v1:UQx+ENGY1x+3T2017'}]}
+        unenrolled_course = {'key': 'UQx+ENGYCAPx', 'course_runs': [{'key': 'cr_key'}]}
+        verified_key = CourseKey.from_string('course-v1:DelftX+NGIx+RA0')
+        audit_key = CourseKey.from_string('course-v1:UQx+ENGY1x+3T2017')
+
+        complete_enrollment, courses_left_to_purchase = partition_courses_by_enrollment(
+            [verified_course, audit_course], {verified_key, audit_key}, {verified_key}
+        )
+        self.assertTrue(complete_enrollment)
+        self.assertEqual([audit_course], courses_left_to_purchase)
+
+        complete_enrollment, courses_left_to_purchase = partition_courses_by_enrollment(
+            [verified_course, audit_course, unenrolled_course], {verified_key, audit_key}, {verified_key}
+        )
+        self.assertFalse(complete_enrollment)
+        self.assertEqual([audit_course, unenrolled_course], courses_left_to_purchase)
 
     def test_price_and_sku_from_empty_course(self):
         course = {}
@@ -108,3 +148,121 @@ class ExperimentUtilsTests(TestCase):
         self.assertEqual(2, len(skus))
         self.assertIn(self.run_a_sku, skus)
         self.assertIn(self.entitlement_a_sku, skus)
+
+    def test_stable_bucketing_hash_group(self):
+        usernames = ('alice', 'bob', 'carol', 'dave')
+        self.assertEqual(
+            [0, 1, 0, 0],
+            [stable_bucketing_hash_group('fbe_access_expiry_reminder', 2, username) for username in usernames]
+        )
+        self.assertEqual(
+            [3, 0, 1, 2],
+            [stable_bucketing_hash_group('test_group', 10, username) for username in usernames]
+        )
+
+
+class ExperimentUserMetadataContextTests(SharedModuleStoreTestCase):
+    """
+    Tests of the user_metadata.html context
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ExperimentUserMetadataContextTests, cls).setUpClass()
+        cls.course = CourseFactory.create()
+
+    def setUp(self):
+        super(ExperimentUserMetadataContextTests, self).setUp()
+        self.user = UserFactory()
+        get_mock_request(self.user)
+        self.addCleanup(crum.set_current_request, None)
+
+    def test_anonymous_user_context(self):
+        with CaptureQueriesContext(connection) as captured_queries:
+            anonymous_context = get_experiment_user_metadata_context(self.course, AnonymousUser())
+        authenticated_context = get_experiment_user_metadata_context(self.course, self.user)
+
+        self.assertEqual(set(authenticated_context), set(anonymous_context))
+        for query in captured_queries.captured_queries:
+            self.assertNotIn('student_courseenrollment', query['sql'])
+            self.assertNotIn('django_comment_client_role', query['sql'])
+
+    @override_waffle_flag(PROGRAM_INFO_FLAG, active=True)
+    @override_waffle_flag(PROGRAM_PRICE_FLAG, active=True)
+    @patch('lms.djangoapps.experiments.utils.get_program_price_and_skus', return_value=(None, None))
+    @patch('lms.djangoapps.experiments.utils.get_programs')
+    def test_program_without_purchasable_courses(self, mock_get_programs, _mock_get_program_price_and_skus):
+        mock_get_programs.return_value = [{
+            'uuid': 'a1b2c3d4',
+            'courses': [{'key': 'UQx+ENGY1x', 'course_runs': [{'key': 'course-v1:UQx+ENGY1x+3T2017'}]}],
+        }]
+
+        context = get_experiment_user_metadata_context(self.course, self.user)
+        program_key_fields = context['program_key_fields']
+        self.assertTrue(program_key_fields['has_courses_left_to_purchase'])
+        self.assertIsNone(program_key_fields['courses_left_to_purchase_price'])
+        self.assertIsNone(program_key_fields['courses_left_to_purchase_url'])
+
+
+@patch('lms.djangoapps.experiments.utils._get_authenticated_user_metadata_context', return_value={})
+class ExperimentUserMetadataContextCacheTests(CacheIsolationTestCase):
+    """
+    Tests of caching the user_metadata.html context of authenticated users
+    """
+    ENABLED_CACHES = ['default']
+
+    def setUp(self):
+        super(ExperimentUserMetadataContextCacheTests, self).setUp()
+        self.course_id = 'course-v1:DelftX+NGIx+RA0'
+        # Only the course key is used when the context is built by the patched helper
+        self.course = Mock(id=CourseKey.from_string(self.course_id))
+        self.user = UserFactory()
+        get_mock_request(self.user)
+        self.addCleanup(crum.set_current_request, None)
+
+    def test_cache_hit(self, mock_get_context):
+        get_experiment_user_metadata_context(self.course, self.user)
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(1, mock_get_context.call_count)
+
+    def test_enrollment_change_clears_cache(self, mock_get_context):
+        get_experiment_user_metadata_context(self.course, self.user)
+        enrollment = CourseEnrollmentFactory(user=self.user, course_id=self.course_id)
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(2, mock_get_context.call_count)
+
+        enrollment.mode = 'verified'
+        enrollment.save()
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(3, mock_get_context.call_count)
+
+        # The program fields depend on all of the user's enrollments, so an enrollment in another course clears the context
+        CourseEnrollmentFactory(user=self.user, course_id='course-v1:UQx+ENGY1x+3T2017', mode='verified')
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(4, mock_get_context.call_count)
+
+    def test_enrollment_deletion_clears_cache(self, mock_get_context):
+        enrollment = CourseEnrollmentFactory(user=self.user, course_id=self.course_id)
+        get_experiment_user_metadata_context(self.course, self.user)
+        enrollment.delete()
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(2, mock_get_context.call_count)
+
+    def test_other_user_enrollment_keeps_cache(self, mock_get_context):
+        get_experiment_user_metadata_context(self.course, self.user)
+        CourseEnrollmentFactory(course_id=self.course_id)
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(1, mock_get_context.call_count)
+
+    def test_masquerading_user_is_not_cached(self, mock_get_context):
+        self.user.masquerade_settings = {self.course.id: Mock()}
+        get_experiment_user_metadata_context(self.course, self.user)
+        get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(2, mock_get_context.call_count)
+
+    def test_flag_state_is_part_of_cache_key(self, mock_get_context):
+        get_experiment_user_metadata_context(self.course, self.user)
+        with override_waffle_flag(PROGRAM_INFO_FLAG, active=True):
+            get_experiment_user_metadata_context(self.course, self.user)
+            get_experiment_user_metadata_context(self.course, self.user)
+        self.assertEqual(2, mock_get_context.call_count)
@@ -3,25 +3,33 @@ Utilities to facilitate experimentation
 """
 
 import hashlib
-import re
 import logging
 from decimal import Decimal
+from uuid import uuid4
+from django.core.cache import cache
+from django.utils.lru_cache import lru_cache
 from student.models import CourseEnrollment
 from django_comment_common.models import Role
 from django.utils.timezone import now
 from lms.djangoapps.commerce.utils import EcommerceService
-from course_modes.models import get_cosmetic_verified_display_price, format_course_price
+from course_modes.models import CourseMode, get_cosmetic_verified_display_price, format_course_price
 from courseware.access import has_staff_access_to_preview_mode
 from courseware.date_summary import verified_upgrade_deadline_link, verified_upgrade_link_is_valid
 from xmodule.partitions.partitions_service import get_user_partition_groups, get_all_partitions_for_course
 from opaque_keys.edx.keys import CourseKey
 from opaque_keys import InvalidKeyError
+from openedx.core.constants import COURSE_PUBLISHED
 from openedx.core.djangoapps.catalog.utils import get_programs
 from openedx.core.djangoapps.waffle_utils import WaffleFlag, WaffleFlagNamespace
 
 
 logger = logging.getLogger(__name__)
 
+# Selects the high bit of each nibble of a 128-bit hash, once that bit has been shifted down into the lowest position
+NIBBLE_HIGH_BITS_MASK = int('1' * 32, 16)
+
+
+WAFFLE_FLAG_NAMESPACE = WaffleFlagNamespace(name=u'experiments')
 
 # TODO: clean up as part of REVEM-199 (START)
 # .. feature_toggle_name: experiments.add_programs
@@ -36,7 +44,7 @@ logger = logging.getLogger(__name__)
 # .. feature_toggle_tickets: REVEM-63, REVEM-198
 # .. feature_toggle_status: supported
 PROGRAM_INFO_FLAG = WaffleFlag(
-    waffle_namespace=WaffleFlagNamespace(name=u'experiments'),
+    waffle_namespace=WAFFLE_FLAG_NAMESPACE,
     flag_name=u'add_programs',
     flag_undefined_default=False
 )
@@ -54,12 +62,24 @@ PROGRAM_INFO_FLAG = WaffleFlag(
 # .. feature_toggle_tickets: REVEM-118, REVEM-206
 # .. feature_toggle_status: supported
 PROGRAM_PRICE_FLAG = WaffleFlag(
-    waffle_namespace=WaffleFlagNamespace(name=u'experiments'),
+    waffle_namespace=WAFFLE_FLAG_NAMESPACE,
     flag_name=u'add_program_price',
     flag_undefined_default=False
 )
+PROGRAM_FLAGS = (PROGRAM_INFO_FLAG, PROGRAM_PRICE_FLAG)
 # TODO: clean up as part of REVEM-199 (END)
 
+# The user metadata context is rebuilt on every courseware render, but its inputs rarely change from one page to the
+# next. Cache it briefly per user, course and program flag state. The key also holds a per-user generation, which is
+# dropped whenever one of the user's enrollments changes (see models.py): the program fields of every course's context
+# depend on all of the user's enrollments. Any other change shows up once the entry expires.
+USER_METADATA_CACHE_KEY_TPL = (
+    u'experiments:user_metadata:v2:{user_id}:{generation}:{course_id}:{program_info_enabled}:{program_price_enabled}'
+)
+USER_METADATA_CACHE_TIMEOUT = 15
+USER_METADATA_GENERATION_CACHE_KEY_TPL = u'experiments:user_metadata_generation:v1:{user_id}'
+USER_METADATA_GENERATION_CACHE_TIMEOUT = 60 * 60
+
 
 def check_and_get_upgrade_link_and_date(user, enrollment=None, course=None):
     """
@@ -98,18 +118,18 @@ def check_and_get_upgrade_link_and_date(user, enrollment=None, course=None):
     return (None, None)
 
 
-# TODO: clean up as part of REVEM-199 (START)
 def get_program_price_and_skus(courses):
     """
     Get the total program price and purchase skus from these courses in the program
     """
-    program_price = 0
+    program_price = Decimal(0)
     skus = []
+    current_time = now()
 
     for course in courses:
-        course_price, course_sku = get_course_entitlement_price_and_sku(course)
+        course_price, course_sku = get_course_entitlement_price_and_sku(course, current_time)
         if course_price is not None and course_sku is not None:
-            program_price = Decimal(program_price) + Decimal(course_price)
+            program_price += Decimal(course_price)
             skus.append(course_sku)
 
     if program_price <= 0:
@@ -122,175 +142,252 @@ def get_program_price_and_skus(courses):
     return program_price, skus
 
 
-def get_course_entitlement_price_and_sku(course):
+def get_course_entitlement_price_and_sku(course, current_time=None):
     """
     Get the entitlement price and sku from this course.
     Try to get them from the first non-expired, verified entitlement that has a price and a sku. If that doesn't work,
     fall back to the first non-expired, verified course run that has a price and a sku.
+
+    current_time may be passed in by callers that check many courses, so it is only computed once.
     """
+    if current_time is None:
+        current_time = now()
     for entitlement in course.get('entitlements', []):
-        if entitlement.get('mode') == 'verified' and entitlement['price'] and entitlement['sku']:
+        if entitlement.get('mode') == CourseMode.VERIFIED and entitlement['price'] and entitlement['sku']:
             expires = entitlement.get('expires')
-            if not expires or expires > now():
+            if not expires or expires > current_time:
                 return entitlement['price'], entitlement['sku']
 
     course_runs = course.get('course_runs', [])
-    published_course_runs = [run for run in course_runs if run['status'] == 'published']
+    published_course_runs = (run for run in course_runs if run['status'] == COURSE_PUBLISHED)
     for published_course_run in published_course_runs:
         for seat in published_course_run['seats']:
-            if seat.get('type') == 'verified' and seat['price'] and seat['sku']:
-                price = Decimal(seat.get('price'))
-                return price, seat.get('sku')
+            if seat.get('type') == CourseMode.VERIFIED and seat['price'] and seat['sku']:
+                return Decimal(seat['price']), seat['sku']
 
     return None, None
 
 
-def get_unenrolled_courses(courses, user_enrollments):
+def partition_courses_by_enrollment(courses, enrollment_course_ids, non_audit_course_ids):
     """
-    Given a list of courses and a list of user enrollments, return the courses in which the user is not enrolled.
-    Depending on the enrollments that are passed in, this method can be used to determine the courses in a program in
-    which the user has not yet enrolled or the courses in a program for which the user has not yet purchased a
-    certificate.
+    Walk the courses once and return a tuple of:
+        - whether the user is enrolled in all of the courses, in any mode
+        - the courses in which the user has no non-audit enrollment
+
+    A user is enrolled in a course if they are enrolled in any of its course runs. Course runs with invalid keys are
+    logged and treated as not enrolled. non_audit_course_ids is expected to be a subset of enrollment_course_ids.
     """
-    # Get the enrollment course ids here, so we don't need to loop through them for every course run
-    enrollment_course_ids = {enrollment.course_id for enrollment in user_enrollments}
-    unenrolled_courses = []
+    enrolled_in_all_courses = True
+    courses_without_non_audit_enrollment = []
 
     for course in courses:
-        if not is_enrolled_in_course(course, enrollment_course_ids):
-            unenrolled_courses.append(course)
-    return unenrolled_courses
+        is_enrolled = has_non_audit_enrollment = False
+        for course_run in course.get('course_runs') or ():
+            key = course_run.get('key')
+            try:
+                course_run_key = _parse_course_key(key)
+            except InvalidKeyError:
+                logger.warn(
+                    u'Unable to determine if user was enrolled since the course key {} is invalid'.format(key)
+                )
+                continue
+            if course_run_key in non_audit_course_ids:
+                is_enrolled = has_non_audit_enrollment = True
+                break
+            if course_run_key in enrollment_course_ids:
+                is_enrolled = True
+
+        if not is_enrolled:
+            enrolled_in_all_courses = False
+        if not has_non_audit_enrollment:
+            courses_without_non_audit_enrollment.append(course)
+
+    return enrolled_in_all_courses, courses_without_non_audit_enrollment
+
+
+@lru_cache(maxsize=4096)
+def _parse_course_key(key):
+    """
+    Parse a catalog course run key, caching the result since the same program course runs are checked repeatedly.
+
+    Raises InvalidKeyError (which is not cached) if the key is invalid.
+    """
+    return CourseKey.from_string(key)
+# TODO: clean up as part of REVEM-199 (END)
 
 
-def is_enrolled_in_all_courses(courses, user_enrollments):
+def _get_user_metadata_cache_key(user_id, generation, course_id, program_info_enabled, program_price_enabled):
     """
-    Determine if the user is enrolled in all of the courses
+    Return the cache key for the user metadata context of this user and course under the given generation and program
+    flag state.
     """
-    # Get the enrollment course ids here, so we don't need to loop through them for every course run
-    enrollment_course_ids = {enrollment.course_id for enrollment in user_enrollments}
-
-    for course in courses:
-        if not is_enrolled_in_course(course, enrollment_course_ids):
-            # User is not enrolled in this course, meaning they are not enrolled in all courses in the program
-            return False
-    # User is enrolled in all courses in the program
-    return True
+    return USER_METADATA_CACHE_KEY_TPL.format(
+        user_id=user_id,
+        generation=generation,
+        course_id=course_id,
+        program_info_enabled=program_info_enabled,
+        program_price_enabled=program_price_enabled,
+    )
 
 
-def is_enrolled_in_course(course, enrollment_course_ids):
+def _get_user_metadata_generation_cache_key(user_id):
     """
-    Determine if the user is enrolled in this course
+    Return the cache key for the generation of the cached user metadata contexts of this user.
     """
-    course_runs = course.get('course_runs')
-    if course_runs:
-        for course_run in course_runs:
-            if is_enrolled_in_course_run(course_run, enrollment_course_ids):
-                return True
-    return False
+    return USER_METADATA_GENERATION_CACHE_KEY_TPL.format(user_id=user_id)
 
 
-def is_enrolled_in_course_run(course_run, enrollment_course_ids):
+def clear_experiment_user_metadata_cache(user_id):
     """
-    Determine if the user is enrolled in this course run
+    Invalidate the cached user metadata contexts of this user in every course, by dropping the user's generation.
     """
-    key = None
-    try:
-        key = course_run.get('key')
-        course_run_key = CourseKey.from_string(key)
-        return course_run_key in enrollment_course_ids
-    except InvalidKeyError:
-        logger.warn(
-            u'Unable to determine if user was enrolled since the course key {} is invalid'.format(key)
-        )
-        return False  # Invalid course run key. Assume user is not enrolled.
-# TODO: clean up as part of REVEM-199 (END)
+    cache.delete(_get_user_metadata_generation_cache_key(user_id))
 
 
 def get_experiment_user_metadata_context(course, user):
     """
     Return a context dictionary with the keys used by the user_metadata.html.
+
+    The context of an authenticated user is cached for USER_METADATA_CACHE_TIMEOUT seconds.
+    """
+    if not user.is_authenticated:
+        # Anonymous users have no enrollments, forum roles or partition groups, so skip looking them up
+        return _build_user_metadata_context(course)
+
+    if getattr(user, 'masquerade_settings', None):
+        # Masquerading changes the staff access and partition groups reported for the user, so it is never cached
+        WAFFLE_FLAG_NAMESPACE.prefetch_flags(PROGRAM_FLAGS)
+        return _get_authenticated_user_metadata_context(course, user)
+
+    # Fetch the user's generation along with the program flags. Waffle uses the default cache unless
+    # WAFFLE_CACHE_NAME says otherwise, in which case the generation is looked up separately below.
+    generation_cache_key = _get_user_metadata_generation_cache_key(user.id)
+    generation = WAFFLE_FLAG_NAMESPACE.prefetch_flags(PROGRAM_FLAGS, cache_keys=[generation_cache_key]).get(
+        generation_cache_key
+    )
+    if generation is None:
+        # A new random generation matches none of the contexts cached before the previous one was dropped
+        generation = cache.get_or_set(
+            generation_cache_key, lambda: uuid4().hex, USER_METADATA_GENERATION_CACHE_TIMEOUT
+        )
+
+    cache_key = _get_user_metadata_cache_key(
+        user.id, generation, course.id, PROGRAM_INFO_FLAG.is_enabled(), PROGRAM_PRICE_FLAG.is_enabled()
+    )
+    return cache.get_or_set(
+        cache_key,
+        lambda: _get_authenticated_user_metadata_context(course, user),
+        USER_METADATA_CACHE_TIMEOUT
+    )
+
+
+def _get_authenticated_user_metadata_context(course, user):
+    """
+    Build the user metadata context for an authenticated user.
     """
     enrollment_mode = None
     enrollment_time = None
-    enrollment = None
     # TODO: clean up as part of REVO-28 (START)
     has_non_audit_enrollments = None
     # TODO: clean up as part of REVO-28 (END)
     # TODO: clean up as part of REVEM-199 (START)
     program_key = None
     # TODO: clean up as part of REVEM-199 (END)
-    try:
-        # TODO: clean up as part of REVO-28 (START)
-        user_enrollments = CourseEnrollment.objects.select_related('course').filter(user_id=user.id)
-        audit_enrollments = user_enrollments.filter(mode='audit')
-        has_non_audit_enrollments = (len(audit_enrollments) != len(user_enrollments))
-        # TODO: clean up as part of REVO-28 (END)
-        # TODO: clean up as part of REVEM-199 (START)
-        if PROGRAM_INFO_FLAG.is_enabled():
-            programs = get_programs(course=course.id)
-            if programs:
-                # A course can be in multiple programs, but we're just grabbing the first one
-                program = programs[0]
-                complete_enrollment = False
-                has_courses_left_to_purchase = False
-                total_courses = None
-                courses = program.get('courses')
-                courses_left_to_purchase_price = None
-                courses_left_to_purchase_url = None
-                program_uuid = program.get('uuid')
-                if courses is not None:
-                    total_courses = len(courses)
-                    complete_enrollment = is_enrolled_in_all_courses(courses, user_enrollments)
-
-                    if PROGRAM_PRICE_FLAG.is_enabled():
-                        # Get the price and purchase URL of the program courses the user has yet to purchase. Say a
-                        # program has 3 courses (A, B and C), and the user previously purchased a certificate for A.
-                        # The user is enrolled in audit mode for B. The "left to purchase price" should be the price of
-                        # B+C.
-                        non_audit_enrollments = [enrollment for enrollment in user_enrollments if enrollment not in
-                                                 audit_enrollments]
-                        courses_left_to_purchase = get_unenrolled_courses(courses, non_audit_enrollments)
-                        if courses_left_to_purchase:
-                            has_courses_left_to_purchase = True
-                        courses_left_to_purchase_price, courses_left_to_purchase_skus = get_program_price_and_skus(
-                            courses_left_to_purchase)
+    # TODO: clean up as part of REVO-28 (START)
+    # Fetch all of the user's enrollments in a single query and do the remaining filtering in python. The course
+    # overview is joined in because the upgrade deadline of the enrollment in this course needs it.
+    user_enrollments = list(CourseEnrollment.objects.select_related('course').filter(user_id=user.id))
+    has_non_audit_enrollments = any(
+        user_enrollment.mode != CourseMode.AUDIT for user_enrollment in user_enrollments
+    )
+    # TODO: clean up as part of REVO-28 (END)
+    # TODO: clean up as part of REVEM-199 (START)
+    if PROGRAM_INFO_FLAG.is_enabled():
+        programs = get_programs(course=course.id)
+        if programs:
+            # A course can be in multiple programs, but we're just grabbing the first one
+            program = programs[0]
+            complete_enrollment = False
+            has_courses_left_to_purchase = False
+            total_courses = None
+            courses = program.get('courses')
+            courses_left_to_purchase_price = None
+            courses_left_to_purchase_url = None
+            program_uuid = program.get('uuid')
+            if courses is not None:
+                total_courses = len(courses)
+                # Get the enrollment course ids here, so we don't need to loop through them for every course run
+                enrollment_course_ids = frozenset(user_enrollment.course_id for user_enrollment in user_enrollments)
+                non_audit_course_ids = frozenset(
+                    user_enrollment.course_id for user_enrollment in user_enrollments
+                    if user_enrollment.mode != CourseMode.AUDIT
+                )
+                # The courses left to purchase are the program courses the user has yet to purchase. Say a program
+                # has 3 courses (A, B and C), and the user previously purchased a certificate for A. The user is
+                # enrolled in audit mode for B. The courses left to purchase are B and C.
+                complete_enrollment, courses_left_to_purchase = partition_courses_by_enrollment(
+                    courses, enrollment_course_ids, non_audit_course_ids
+                )
+
+                if PROGRAM_PRICE_FLAG.is_enabled():
+                    # Get the price and purchase URL of the courses left to purchase
+                    if courses_left_to_purchase:
+                        has_courses_left_to_purchase = True
+                    courses_left_to_purchase_price, courses_left_to_purchase_skus = get_program_price_and_skus(
+                        courses_left_to_purchase)
+                    # There is nothing to check out if none of the courses left to purchase has a price and sku
+                    if courses_left_to_purchase_skus:
                         courses_left_to_purchase_url = EcommerceService().get_checkout_page_url(
                             *courses_left_to_purchase_skus, program_uuid=program_uuid)
 
-                program_key = {
-                    'uuid': program_uuid,
-                    'title': program.get('title'),
-                    'marketing_url': program.get('marketing_url'),
-                    'total_courses': total_courses,
-                    'complete_enrollment': complete_enrollment,
-                    'has_courses_left_to_purchase': has_courses_left_to_purchase,
-                    'courses_left_to_purchase_price': courses_left_to_purchase_price,
-                    'courses_left_to_purchase_url': courses_left_to_purchase_url,
-                }
-        # TODO: clean up as part of REVEM-199 (END)
-        enrollment = CourseEnrollment.objects.select_related(
-            'course'
-        ).get(user_id=user.id, course_id=course.id)
-        if enrollment.is_active:
-            enrollment_mode = enrollment.mode
-            enrollment_time = enrollment.created
-    except CourseEnrollment.DoesNotExist:
-        pass  # Not enrolled, used the default None values
+            program_key = {
+                'uuid': program_uuid,
+                'title': program.get('title'),
+                'marketing_url': program.get('marketing_url'),
+                'total_courses': total_courses,
+                'complete_enrollment': complete_enrollment,
+                'has_courses_left_to_purchase': has_courses_left_to_purchase,
+                'courses_left_to_purchase_price': courses_left_to_purchase_price,
+                'courses_left_to_purchase_url': courses_left_to_purchase_url,
+            }
+    # TODO: clean up as part of REVEM-199 (END)
+    enrollment = next(
+        (user_enrollment for user_enrollment in user_enrollments if user_enrollment.course_id == course.id), None
+    )
+    if enrollment and enrollment.is_active:
+        enrollment_mode = enrollment.mode
+        enrollment_time = enrollment.created
 
     # upgrade_link and upgrade_date should be None if user has passed their dynamic pacing deadline.
     upgrade_link, upgrade_date = check_and_get_upgrade_link_and_date(user, enrollment, course)
     has_staff_access = has_staff_access_to_preview_mode(user, course.id)
-    forum_roles = []
-    if user.is_authenticated:
-        forum_roles = list(Role.objects.filter(users=user, course_id=course.id).values_list('name').distinct())
+    forum_roles = list(Role.objects.filter(users=user, course_id=course.id).values_list('name').distinct())
 
     # get user partition data
-    if user.is_authenticated():
-        partition_groups = get_all_partitions_for_course(course)
-        user_partitions = get_user_partition_groups(course.id, partition_groups, user, 'name')
-    else:
-        user_partitions = {}
-
+    partition_groups = get_all_partitions_for_course(course)
+    user_partitions = get_user_partition_groups(course.id, partition_groups, user, 'name')
+
+    return _build_user_metadata_context(
+        course,
+        upgrade_link=upgrade_link,
+        upgrade_date=upgrade_date,
+        enrollment_mode=enrollment_mode,
+        enrollment_time=enrollment_time,
+        has_staff_access=has_staff_access,
+        forum_roles=forum_roles,
+        partition_groups=user_partitions,
+        has_non_audit_enrollments=has_non_audit_enrollments,
+        program_key=program_key,
+    )
+
+
+def _build_user_metadata_context(course, upgrade_link=None, upgrade_date=None, enrollment_mode=None,
+                                 enrollment_time=None, has_staff_access=False, forum_roles=None,
+                                 partition_groups=None, has_non_audit_enrollments=False,
+                                 program_key=None):  # pylint: disable=too-many-arguments
+    """
+    Return the user_metadata.html context for the course. The defaults are the values of an anonymous user.
+    """
     return {
         'upgrade_link': upgrade_link,
         'upgrade_price': unicode(get_cosmetic_verified_display_price(course)),
@@ -302,8 +399,8 @@ def get_experiment_user_metadata_context(course, user):
         'course_start': course.start,
         'course_end': course.end,
         'has_staff_access': has_staff_access,
-        'forum_roles': forum_roles,
-        'partition_groups': user_partitions,
+        'forum_roles': forum_roles if forum_roles is not None else [],
+        'partition_groups': partition_groups if partition_groups is not None else {},
         # TODO: clean up as part of REVO-28 (START)
         'has_non_audit_enrollments': has_non_audit_enrollments,
         # TODO: clean up as part of REVO-28 (END)
@@ -337,9 +434,10 @@ def stable_bucketing_hash_group(group_name, group_count, username):
         group_count: How many groups to bucket users into.
         username: The username of the user being bucketed.
     """
-    hasher = hashlib.md5()
-    hasher.update(group_name.encode('utf-8'))
-    hasher.update(username.encode('utf-8'))
-    hash_str = hasher.hexdigest()
+    hasher = hashlib.md5(group_name.encode('utf-8') + username.encode('utf-8'))
+    # Each hex digit of the hash contributes one bit: 1 if the digit is 8-f, 0 if it is 0-7.
+    # Isolate the high bit of every nibble, which leaves a hex string made only of 0s and 1s
+    # that can be read back directly as a binary number.
+    nibble_high_bits = (int(hasher.hexdigest(), 16) >> 3) & NIBBLE_HIGH_BITS_MASK
 
-    return int(re.sub('[8-9a-f]', '1', re.sub('[0-7]', '0', hash_str)), 2) % group_count
+    return int(format(nibble_high_bits, '032x'), 2) % group_count
@@ -294,6 +294,56 @@ class WaffleFlagNamespace(WaffleNamespace):
                 self._cached_flags[namespaced_flag_name] = value
         return value
 
+    def prefetch_flags(self, flags, cache_keys=()):
+        """
+        Caches whether each of the provided flags is active, using a single
+        waffle cache round trip for all of them.
+
+        Flags that are already cached in the request are left untouched.
+        Flags that are missing from the waffle cache are left for
+        is_flag_active to resolve the usual way.
+
+        Course overrides are not prefetched; CourseWaffleFlag still checks
+        them before the cached waffle value.
+
+        Arguments:
+            flags (list of WaffleFlag): The flags of this namespace to cache.
+            cache_keys (list of String): (Optional) Other keys to fetch from
+                the waffle cache in the same round trip.
+
+        Returns:
+            A dict of the values of cache_keys found in the waffle cache.
+        """
+        # Import is placed here to avoid model import at project startup.
+        from waffle.models import CACHE_EMPTY, Flag
+        from waffle.utils import get_cache as get_waffle_cache
+
+        flags_by_cache_key = {}
+        request = crum.get_current_request()
+        # Flags are not cached outside of a request context (see is_flag_active).
+        if request:
+            for flag in flags:
+                namespaced_flag_name = self._namespaced_name(flag.flag_name)
+                if namespaced_flag_name not in self._cached_flags:
+                    flags_by_cache_key[Flag._cache_key(namespaced_flag_name)] = flag  # pylint: disable=protected-access
+        if not flags_by_cache_key and not cache_keys:
+            return {}
+
+        cached_values = get_waffle_cache().get_many(list(flags_by_cache_key) + list(cache_keys))
+        for cache_key, flag in flags_by_cache_key.items():
+            if cache_key not in cached_values:
+                continue
+            waffle_flag = cached_values[cache_key]
+            if waffle_flag == CACHE_EMPTY:
+                # The flag is undefined in waffle
+                if flag.flag_undefined_default is None:
+                    continue
+                value = flag.flag_undefined_default
+            else:
+                value = waffle_flag.is_active(request)
+            self._cached_flags[self._namespaced_name(flag.flag_name)] = value
+        return {key: cached_values[key] for key in cache_keys if key in cached_values}
+
 
 class WaffleFlag(object):
     """
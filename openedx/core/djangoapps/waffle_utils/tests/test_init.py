@@ -8,10 +8,15 @@ from django.test.client import RequestFactory
 from edx_django_utils.cache import RequestCache
 from mock import patch
 from opaque_keys.edx.keys import CourseKey
+from waffle.models import CACHE_EMPTY, Flag
 from waffle.testutils import override_flag
+from waffle.utils import get_cache as get_waffle_cache
 
-from .. import CourseWaffleFlag, WaffleFlagNamespace, WaffleSwitchNamespace, WaffleSwitch
+from openedx.core.djangolib.testing.utils import CacheIsolationTestCase
+
+from .. import CourseWaffleFlag, WaffleFlag, WaffleFlagNamespace, WaffleSwitchNamespace, WaffleSwitch
 from ..models import WaffleFlagCourseOverrideModel
+from ..testutils import override_waffle_flag
 
 
 @ddt.ddt
@@ -115,6 +120,93 @@ class TestCourseWaffleFlag(TestCase):
         self.assertEqual(test_course_flag.is_enabled(self.TEST_COURSE_KEY), data['result'])
 
 
+class TestWaffleFlagNamespacePrefetch(CacheIsolationTestCase):
+    """
+    Tests WaffleFlagNamespace.prefetch_flags.
+    """
+    ENABLED_CACHES = ['default']
+
+    NAMESPACE_NAME = "test_namespace"
+    FLAG_NAME = "test_flag"
+    NAMESPACED_FLAG_NAME = NAMESPACE_NAME + "." + FLAG_NAME
+
+    TEST_NAMESPACE = WaffleFlagNamespace(NAMESPACE_NAME)
+    TEST_FLAG = WaffleFlag(TEST_NAMESPACE, FLAG_NAME, flag_undefined_default=False)
+
+    def setUp(self):
+        super(TestWaffleFlagNamespacePrefetch, self).setUp()
+        request = RequestFactory().request()
+        self.addCleanup(crum.set_current_request, None)
+        crum.set_current_request(request)
+        RequestCache.clear_all_namespaces()
+        self.waffle_cache_key = Flag._cache_key(self.NAMESPACED_FLAG_NAME)  # pylint: disable=protected-access
+
+    def get_request_cached_value(self):
+        """
+        Returns the value of the flag stored in the request cache, if any.
+        """
+        return self.TEST_NAMESPACE._cached_flags.get(self.NAMESPACED_FLAG_NAME)  # pylint: disable=protected-access
+
+    def assert_prefetched_value_matches_is_enabled(self, expected):
+        """
+        Asserts that the flag is enabled as expected after prefetching, and
+        that checking it again without the prefetch gives the same result.
+        """
+        self.assertEqual(self.TEST_FLAG.is_enabled(), expected)
+        RequestCache.clear_all_namespaces()
+        self.assertEqual(self.TEST_FLAG.is_enabled(), expected)
+
+    def test_defined_active_flag(self):
+        flag = Flag.objects.create(name=self.NAMESPACED_FLAG_NAME, everyone=True)
+        get_waffle_cache().set(self.waffle_cache_key, flag)
+
+        self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG])
+        self.assertTrue(self.get_request_cached_value())
+        self.assert_prefetched_value_matches_is_enabled(True)
+
+    def test_defined_inactive_flag(self):
+        flag = Flag.objects.create(name=self.NAMESPACED_FLAG_NAME, everyone=False)
+        get_waffle_cache().set(self.waffle_cache_key, flag)
+
+        self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG])
+        self.assertIs(self.get_request_cached_value(), False)
+        self.assert_prefetched_value_matches_is_enabled(False)
+
+    def test_undefined_flag(self):
+        get_waffle_cache().set(self.waffle_cache_key, CACHE_EMPTY)
+
+        self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG])
+        self.assertIs(self.get_request_cached_value(), self.TEST_FLAG.flag_undefined_default)
+        self.assert_prefetched_value_matches_is_enabled(False)
+
+    def test_flag_missing_from_cache(self):
+        Flag.objects.create(name=self.NAMESPACED_FLAG_NAME, everyone=True)
+
+        self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG])
+        self.assertIsNone(self.get_request_cached_value())
+        self.assert_prefetched_value_matches_is_enabled(True)
+
+    def test_overridden_flag_is_not_replaced(self):
+        flag = Flag.objects.create(name=self.NAMESPACED_FLAG_NAME, everyone=False)
+        get_waffle_cache().set(self.waffle_cache_key, flag)
+
+        with override_waffle_flag(self.TEST_FLAG, active=True):
+            self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG])
+            self.assertTrue(self.get_request_cached_value())
+            self.assert_prefetched_value_matches_is_enabled(True)
+
+    def test_without_request(self):
+        crum.set_current_request(None)
+        self.assertEqual(self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG]), {})
+        self.assertIsNone(self.get_request_cached_value())
+
+    def test_other_cache_keys(self):
+        get_waffle_cache().set('test_key', 'test_value')
+
+        cached_values = self.TEST_NAMESPACE.prefetch_flags([self.TEST_FLAG], cache_keys=['test_key', 'missing_key'])
+        self.assertEqual(cached_values, {'test_key': 'test_value'})
+
+
 class TestWaffleSwitch(TestCase):
     """
     Tests the WaffleSwitch.